@@ -25,9 +25,19 @@ except ImportError:
     setup_underactuated()
 
 # python libraries
+import collections
+import functools
+import multiprocessing
+import os
+import time
+import tracemalloc
 import numpy as np
 import matplotlib.pyplot as plt
 
+# The benchmarks of this notebook run at smoke-test sizes by default, so running the
+# notebook (and the autograder) stays fast. Set to True for the full problem sizes.
+full_benchmarks = False
+
 """## Problem Description
 In this problem set, you will write code for the Rapidly-Exploring Random Tree (RRT), which is an algorithm designed to efficiently search nonconvex, high-dimensional spaces by randomly building a space-filling tree. Building on this implementation you will also implement RRT*, a variant of RRT that converges towards an optimal solution.
 
@@ -85,16 +95,314 @@ Your task is to complete the RRT implementation below to find a collision-free p
 Note that you only have to change the code where indicated by `# modify here`.
 """
 
+"""The planners store their tree in a `Tree`: instead of one Python object per node, the positions of all nodes, the index of the parent of every node (`-1` for the root) and the costs of the paths from the root are stored in contiguous arrays. The arrays double their capacity when they are full, so adding a node takes amortized constant time. The `Node` objects of the planners below are either free nodes, e.g. a random sample, or light handles of one node in a tree that read and write the arrays.
+
+Finding the nearest node by computing the distance to every node in the tree makes each iteration $O(n)$ and the whole planning $O(n^2)$. Every tree therefore keeps the positions of its nodes in a `NodeGrid`, a uniform grid hash that is updated whenever a node is added. A nearest neighbor query searches the cells in rings of growing size around the query point and stops as soon as no cell of the next ring can contain a closer node. A radius query, used by RRT* to find the candidate parents of a new node, only checks the nodes in the cells that overlap the bounding box of the query circle. Whenever the number of nodes doubles, the grid is rebuilt with a cell size that keeps about `nodes_per_cell` nodes in every cell of the bounded domain."""
+
+class NodeGrid:
+
+    def __init__(self, tree, bounds, nodes_per_cell=4):
+        self.tree = tree
+        self.bounds = bounds
+        self.nodes_per_cell = nodes_per_cell
+        self.n = 0
+        self.rebuild(cell_size=float(bounds[1] - bounds[0]))
+
+    def __len__(self):
+        return self.n
+
+    def cell(self, p):
+        return tuple(np.floor(p[:2] / self.cell_size).astype(int))
+
+    def rebuild(self, cell_size):
+        """Rebuild the cells with the given cell_size"""
+        self.cell_size = cell_size
+        self.cells = {}
+        self.cell_min = np.array([np.iinfo(int).max]*2)
+        self.cell_max = np.array([np.iinfo(int).min]*2)
+        for i in range(self.n):
+            self.insert_cell(i)
+        self.rebuild_at = max(2*self.n, 64)
+
+    def insert_cell(self, i):
+        c = self.cell(self.tree.positions[i])
+        self.cells.setdefault(c, []).append(i)
+        self.cell_min = np.minimum(self.cell_min, c)
+        self.cell_max = np.maximum(self.cell_max, c)
+
+    def insert(self, i):
+        """Add node i of the tree, nodes have to be inserted in order"""
+        self.n += 1
+        self.insert_cell(i)
+        if self.n >= self.rebuild_at:
+            extent = float(self.bounds[1] - self.bounds[0])
+            self.rebuild(extent / np.sqrt(self.n / self.nodes_per_cell))
+
+    def ring(self, c, k):
+        """Indices of the nodes in all cells at Chebyshev distance k from cell c"""
+        x, y = c
+        if k == 0:
+            cells = [(x, y)]
+        else:
+            cells = [(x + i, y + j) for i in range(-k, k + 1) for j in (-k, k)]
+            cells += [(x + i, y + j) for i in (-k, k) for j in range(-k + 1, k)]
+        inds = []
+        for cell in cells:
+            inds += self.cells.get(cell, [])
+        return inds
+
+    def nearest(self, p):
+        """Index of the node nearest to p. Ties are broken by the lowest index."""
+        c = self.cell(p)
+        # Rings beyond the occupied cells are empty
+        k_max = int(np.max(np.maximum(np.abs(self.cell_min - c), np.abs(self.cell_max - c))))
+        best_ind, best_d = None, np.inf
+        for k in range(k_max + 1):
+            inds = self.ring(c, k)
+            if inds:
+                dlist = np.sum(np.square(p - self.tree.positions[inds]), axis=1)
+                d = dlist.min()
+                ind = min(i for i, di in zip(inds, dlist) if di == d)
+                if d < best_d or (d == best_d and ind < best_ind):
+                    best_ind, best_d = ind, d
+            # Nodes outside of the first k+1 rings are at least k*cell_size away
+            if best_d < (k*self.cell_size)**2:
+                break
+        return best_ind
+
+    def within(self, p, r):
+        """Indices of the nodes within distance r of p in ascending order"""
+        lo = np.maximum(np.floor((p[:2] - r) / self.cell_size).astype(int), self.cell_min)
+        hi = np.minimum(np.floor((p[:2] + r) / self.cell_size).astype(int), self.cell_max)
+        if np.any(hi < lo):
+            return np.empty(0, dtype=int)
+        if np.prod(hi - lo + 1) >= len(self.cells):
+            # The query covers about all occupied cells
+            inds = np.arange(self.n)
+        else:
+            inds = []
+            for x in range(lo[0], hi[0] + 1):
+                for y in range(lo[1], hi[1] + 1):
+                    inds += self.cells.get((x, y), [])
+            inds = np.array(inds, dtype=int)
+        dlist = np.sum(np.square(self.tree.positions[inds] - p), axis=1)
+        return np.sort(inds[dlist <= r ** 2])
+
+class Tree:
+
+    def __init__(self, bounds, dim=2, capacity=1024):
+        self.positions = np.empty((capacity, dim))
+        self.parents = np.empty(capacity, dtype=int)
+        self.costs = np.empty(capacity)
+        # Indices of the children of every node
+        self.children = []
+        self.n = 0
+        self.grid = NodeGrid(self, bounds)
+        # Parents of nodes that are not part of the tree themselves
+        self.outside_parents = {}
+
+    def __len__(self):
+        return self.n
+
+    def add(self, p, parent=-1, cost=0.0):
+        """Add a node and return its index"""
+        if self.n == len(self.parents):
+            # Double the capacity
+            self.positions = np.concatenate((self.positions, np.empty_like(self.positions)))
+            self.parents = np.concatenate((self.parents, np.empty_like(self.parents)))
+            self.costs = np.concatenate((self.costs, np.empty_like(self.costs)))
+        i = self.n
+        self.positions[i] = p
+        self.parents[i] = parent
+        self.costs[i] = cost
+        self.children.append([])
+        if parent >= 0:
+            self.children[parent].append(i)
+        self.n += 1
+        self.grid.insert(i)
+        return i
+
+    def index_of(self, node):
+        """Index of node in the tree. A node that is not part of the tree is added to it
+        and becomes a handle of the new tree node."""
+        if node.tree is self:
+            return node.index
+        parent = node.parent
+        i = self.add(node.p, cost=getattr(node, "cost", 0.0))
+        node.tree, node.index = self, i
+        node.parent = parent
+        return i
+
+    def set_parent(self, i, parent):
+        """Set the parent of node i to the node parent, which may be outside of the tree"""
+        self.outside_parents.pop(i, None)
+        if self.parents[i] >= 0:
+            self.children[self.parents[i]].remove(i)
+        if parent is not None and parent.tree is self:
+            self.parents[i] = parent.index
+            self.children[parent.index].append(i)
+        else:
+            self.parents[i] = -1
+            if parent is not None:
+                self.outside_parents[i] = parent
+
+    def path_to_root(self, i):
+        """Indices of the nodes from node i to the root"""
+        inds = [i]
+        while self.parents[inds[-1]] >= 0:
+            inds.append(self.parents[inds[-1]])
+        return inds
+
+class NodeList:
+    """The nodes of a tree as a list of Node handles"""
+
+    def __init__(self, tree, node_class):
+        self.tree = tree
+        self.node_class = node_class
+
+    def __len__(self):
+        return len(self.tree)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.tree)
+        if not 0 <= i < len(self.tree):
+            raise IndexError("node index out of range")
+        return self.node_class.handle(self.tree, i)
+
+    def __iter__(self):
+        for i in range(len(self.tree)):
+            yield self.node_class.handle(self.tree, i)
+
+    def append(self, node):
+        self.tree.index_of(node)
+
+def pack_obstacles(obstacle_list):
+    """Circular obstacles as an array with rows (x, y, radius)"""
+    return np.asarray(obstacle_list, dtype=float).reshape(-1, 3)
+
+def circle_collision(p1, p2, obstacles):
+    """Check whether the line segments from p1 to p2 are in collision with the circles
+    (x, y, radius) in obstacles, broadcasting over all but the last dimension
+    """
+    center_circle = obstacles[..., :2]
+    d12 = p2 - p1 # the directional vector from p1 to p2
+    d1c = center_circle - p1 # the directional vector from circle to p1
+    # t is where the line v(t) := p1 + d12*t and the circle are closest
+    t = np.sum(d12*d1c, axis=-1) / (np.sum(d12*d12, axis=-1) + 1e-7)
+    t = np.clip(t, 0, 1) # Our line segment is bounded 0<=t<=1
+    d = p1 + d12*t[..., None] # The point where the line segment and circle are closest
+    return np.sum(np.square(center_circle - d), axis=-1) < obstacles[..., 2]**2
+
+"""With many obstacles, most of them are far away from any given segment. An `ObstacleGrid` is a broad phase for the collision checks: every circle is registered in the cells of a uniform grid that overlap its bounding box, enlarged by half a cell. The segments are sampled at intervals of one cell size, so that every point of a segment is within half a cell of a sample. A segment is then only checked exactly against the circles registered in the cells of its samples. The cells are stored as sorted arrays, so the candidates of a whole batch of segments are found without Python loops. Scenes with only a few obstacles are checked against all of them directly."""
+
+class ObstacleGrid:
+
+    def __init__(self, obstacle_list, cell_size=None, min_obstacles=64):
+        self.obstacles = pack_obstacles(obstacle_list)
+        self.min_obstacles = min_obstacles
+        if len(self.obstacles) <= min_obstacles:
+            return
+        centers, radii = self.obstacles[:, :2], self.obstacles[:, 2]
+        if cell_size is None:
+            # About four cells per obstacle, but cells at least as large as the obstacles
+            extent = np.max(np.max(centers + radii[:, None], axis=0) - np.min(centers - radii[:, None], axis=0))
+            cell_size = max(extent / np.sqrt(4*len(self.obstacles)), 2*np.median(radii))
+        self.cell_size = cell_size
+        margin = radii[:, None] + cell_size/2
+        lo = np.floor((centers - margin) / cell_size).astype(int)
+        hi = np.floor((centers + margin) / cell_size).astype(int)
+        self.origin = lo.min(axis=0)
+        self.shape = hi.max(axis=0) - self.origin + 1
+        cell_ids, obstacle_ids = [], []
+        for i, (l, h) in enumerate(zip(lo - self.origin, hi - self.origin)):
+            x, y = np.meshgrid(np.arange(l[0], h[0] + 1), np.arange(l[1], h[1] + 1), indexing="ij")
+            cell_ids.append((x*self.shape[1] + y).ravel())
+            obstacle_ids.append(np.full(x.size, i))
+        cell_ids, obstacle_ids = np.concatenate(cell_ids), np.concatenate(obstacle_ids)
+        order = np.argsort(cell_ids, kind="stable")
+        # The obstacles of cell c are cell_obstacles[cell_start[c]:cell_start[c + 1]]
+        self.cell_obstacles = obstacle_ids[order]
+        self.cell_start = np.searchsorted(cell_ids[order], np.arange(np.prod(self.shape) + 1))
+
+    def __len__(self):
+        return len(self.obstacles)
+
+    def segments_collision(self, p1, p2):
+        """Check for each line segment from p1[i] to p2[i] whether it is in collision
+        with any obstacle
+        """
+        if len(self.obstacles) <= self.min_obstacles:
+            return RRT.segments_collision(p1, p2, self.obstacles)
+        p1, p2 = np.broadcast_arrays(np.atleast_2d(p1), np.atleast_2d(p2))
+        collide = np.zeros(len(p1), dtype=bool)
+        # Samples at intervals of at most one cell size along every segment
+        n_samples = np.ceil(np.linalg.norm(p2 - p1, axis=1) / self.cell_size).astype(int) + 1
+        t = np.minimum(np.arange(n_samples.max(initial=1)) / np.maximum(n_samples - 1, 1)[:, None], 1)
+        samples = p1[:, None] + (p2 - p1)[:, None]*t[:, :, None]
+        cells = np.floor(samples[:, :, :2] / self.cell_size).astype(int) - self.origin
+        inside = np.all((cells >= 0) & (cells < self.shape), axis=2)
+        segment_ids = np.repeat(np.arange(len(p1)), t.shape[1])[inside.ravel()]
+        cell_ids = cells[inside][:, 0]*self.shape[1] + cells[inside][:, 1]
+        # Obstacles registered in the cells of every segment
+        counts = self.cell_start[cell_ids + 1] - self.cell_start[cell_ids]
+        offsets = np.repeat(self.cell_start[cell_ids] - np.cumsum(counts) + counts, counts)
+        obstacle_ids = self.cell_obstacles[offsets + np.arange(counts.sum())]
+        # Obstacles in several cells of a segment are checked more than once,
+        # which is cheaper than removing the duplicates
+        s = np.repeat(segment_ids, counts)
+        collide[s[circle_collision(p1[s], p2[s], self.obstacles[obstacle_ids])]] = True
+        return collide
+
 class RRT:
  
     class Node:
         def __init__(self, p):
+            self.tree = None
+            self.index = None
             self.p = np.array(p)
             self.parent = None
 
+        @classmethod
+        def handle(cls, tree, index):
+            """Node that refers to node index of tree"""
+            node = cls.__new__(cls)
+            node.tree = tree
+            node.index = index
+            return node
+
+        @property
+        def p(self):
+            if self.tree is None:
+                return self._p
+            return self.tree.positions[self.index]
+
+        @p.setter
+        def p(self, p):
+            if self.tree is None:
+                self._p = p
+            else:
+                self.tree.positions[self.index] = p
+
+        @property
+        def parent(self):
+            if self.tree is None:
+                return self._parent
+            parent = self.tree.parents[self.index]
+            if parent < 0:
+                return self.tree.outside_parents.get(self.index)
+            return self.handle(self.tree, parent)
+
+        @parent.setter
+        def parent(self, parent):
+            if self.tree is None:
+                self._parent = parent
+            else:
+                self.tree.set_parent(self.index, parent)
+
     def __init__(self, start, goal, obstacle_list, bounds, 
                  max_extend_length=3.0, path_resolution=0.5, 
-                 goal_sample_rate=0.05, max_iter=100):
+                 goal_sample_rate=0.05, max_iter=100, seed=None, sample_block_size=1024):
         self.start = self.Node(start)
         self.goal = self.Node(goal)
         self.bounds = bounds
@@ -103,11 +411,52 @@ class RRT:
         self.goal_sample_rate = goal_sample_rate
         self.max_iter = max_iter
         self.obstacle_list = obstacle_list
+        self.obstacle_grid = ObstacleGrid(obstacle_list)
         self.node_list = []
+        # Without a seed, the seed is drawn from the global generator, so that
+        # np.random.seed still makes the planners reproducible
+        if seed is None:
+            seed = np.random.randint(2**63, dtype=np.int64)
+        self.rng = np.random.default_rng(seed)
+        self.sample_block_size = sample_block_size
+        self.samples = np.empty((0, len(self.start.p)))
+        self.sample_ind = 0
+
+    @property
+    def node_list(self):
+        """The nodes of the tree"""
+        return NodeList(self.tree, self.Node)
+
+    @node_list.setter
+    def node_list(self, nodes):
+        nodes = list(nodes)
+        parents = [node.parent for node in nodes]
+        def key(node):
+            return id(node) if node.tree is None else (id(node.tree), node.index)
+        index = {key(node): i for i, node in enumerate(nodes)}
+        self.tree = Tree(self.bounds, dim=len(self.start.p))
+        for node in nodes:
+            self.tree.index_of(node)
+        for i, parent in enumerate(parents):
+            if parent is not None and key(parent) in index:
+                parent = self.Node.handle(self.tree, index[key(parent)])
+            self.tree.set_parent(i, parent)
+
+    def reset_tree(self, root):
+        """Start a new tree from the root node"""
+        self.node_list = [root]
+
+    def add_node(self, node):
+        """Add node to the tree"""
+        self.tree.index_of(node)
+
+    def nearest_node(self, node):
+        """Find the nearest node in the tree to node"""
+        return self.Node.handle(self.tree, self.tree.grid.nearest(node.p))
 
     def plan(self):
         """Plans the path from start to goal while avoiding obstacles"""
-        self.node_list = [self.start]
+        self.reset_tree(self.start)
         for i in range(self.max_iter):
             # modify here: 
             # 1) Create a random node (rnd_node) inside 
@@ -122,13 +471,13 @@ class RRT:
             # If the new_node is very close to the goal, connect it
             # directly to the goal and return the final path
             rnd_node = self.get_random_node()
-            nearest_node = RRT.get_nearest_node(self.node_list, rnd_node)
+            nearest_node = self.nearest_node(rnd_node)
             new_node = self.steer(nearest_node, rnd_node)
-            if not RRT.collision(nearest_node, new_node, self.obstacle_list):
-              self.node_list.append(new_node)
+            if not RRT.collision(nearest_node, new_node, self.obstacle_grid):
+              self.add_node(new_node)
             if self.dist_to_goal(self.node_list[-1].p) <= self.max_extend_length:
                 final_node = self.steer(self.node_list[-1], self.goal, self.max_extend_length)
-                if not self.collision(final_node, self.node_list[-1], self.obstacle_list):
+                if not self.collision(final_node, self.node_list[-1], self.obstacle_grid):
                     return self.final_path(len(self.node_list) - 1)
         return None  # cannot find path
 
@@ -151,13 +500,24 @@ class RRT:
 
     def get_random_node(self):
         """Sample random node inside bounds or sample goal point"""
-        if np.random.rand() > self.goal_sample_rate:
+        if self.sample_ind == len(self.samples):
+            self.draw_samples()
+        i = self.sample_ind
+        self.sample_ind += 1
+        if not self.sample_goal[i]:
             # Sample random point inside boundaries
-            rnd = self.Node(np.random.rand(2)*(self.bounds[1]-self.bounds[0]) + self.bounds[0])
+            rnd = self.Node(self.samples[i])
         else:  
             # Select goal point
             rnd = self.Node(self.goal.p)
         return rnd
+
+    def draw_samples(self):
+        """Draw the next block of random points and goal sampling decisions"""
+        n, dim = self.sample_block_size, len(self.start.p)
+        self.sample_goal = self.rng.random(n) <= self.goal_sample_rate
+        self.samples = self.rng.random((n, dim))*(self.bounds[1]-self.bounds[0]) + self.bounds[0]
+        self.sample_ind = 0
     
     @staticmethod
     def get_nearest_node(node_list, node):
@@ -171,8 +531,41 @@ class RRT:
         """Check whether the path connecting node1 and node2 
         is in collision with anyting from the obstacle_list
         """
-        p1 = node2.p
-        p2 = node1.p 
+        return RRT.segment_collision(node2.p, node1.p, obstacle_list)
+
+    @staticmethod
+    def segment_collision(p1, p2, obstacle_list):
+        """Check whether the line segment from p1 to p2 is in collision
+        with anything from the obstacle_list
+        """
+        return bool(RRT.segments_collision(p1, p2, obstacle_list)[0])
+
+    @staticmethod
+    def segments_collision(p1, p2, obstacle_list, block_size=256):
+        """Check for each line segment from p1[i] to p2[i] whether it is in collision
+        with anything from the obstacle_list
+        """
+        if isinstance(obstacle_list, ObstacleGrid):
+            return obstacle_list.segments_collision(p1, p2)
+        p1, p2 = np.broadcast_arrays(np.atleast_2d(p1), np.atleast_2d(p2))
+        obstacles = pack_obstacles(obstacle_list)
+        collide = np.zeros(len(p1), dtype=bool)
+        # Segments that are not in collision with any obstacle checked so far
+        free = np.arange(len(p1))
+        for i in range(0, len(obstacles), block_size):
+            is_collide = np.any(circle_collision(p1[free, None], p2[free, None],
+                                                 obstacles[None, i:i + block_size]), axis=1)
+            collide[free[is_collide]] = True
+            free = free[~is_collide]
+            if len(free) == 0:
+                break
+        return collide
+
+    @staticmethod
+    def segment_collision_loop(p1, p2, obstacle_list):
+        """Check whether the line segment from p1 to p2 is in collision
+        with anything from the obstacle_list, one obstacle at a time
+        """
         for o in obstacle_list:
             center_circle = o[0:2]
             radius = o[2]
@@ -193,20 +586,23 @@ class RRT:
     def final_path(self, goal_ind):
         """Compute the final path from the goal node to the start node"""
         path = [self.goal.p]
-        node = self.node_list[goal_ind]
         # modify here: Generate the final path from the goal node to the start node.
         # We will check that path[0] == goal and path[-1] == start
-        while True:
-          path.append(node.p)
-          if np.array_equal(node.p, self.start.p):
-            break
-          node = node.parent
+        path += list(self.tree.positions[self.tree.path_to_root(goal_ind)])
         return path
 
     def draw_graph(self):
-        for node in self.node_list:
-            if node.parent:
-                plt.plot([node.p[0], node.parent.p[0]], [node.p[1], node.parent.p[1]], "-g")
+        self.draw_tree(self.tree, "-g")
+
+    @staticmethod
+    def draw_tree(tree, style):
+        """Plot all edges of the tree"""
+        inds = np.flatnonzero(tree.parents[:len(tree)] >= 0)
+        # One polyline of all edges, separated by NaNs
+        segments = np.full((len(inds), 3, 2), np.nan)
+        segments[:, 0] = tree.positions[inds, :2]
+        segments[:, 1] = tree.positions[tree.parents[inds], :2]
+        plt.plot(segments[:, :, 0].ravel(), segments[:, :, 1].ravel(), style)
 
 """You can view the result of your implementation below. If you did everything correctly, the RRT should be able to find a feasible path from the start to the goal location."""
 
@@ -272,63 +668,145 @@ class RRTStar(RRT):
             super().__init__(p)
             self.cost = 0.0
 
+        @property
+        def cost(self):
+            if self.tree is None:
+                return self._cost
+            return self.tree.costs[self.index]
+
+        @cost.setter
+        def cost(self, cost):
+            if self.tree is None:
+                self._cost = cost
+            else:
+                self.tree.costs[self.index] = cost
+
     def __init__(self, start, goal, obstacle_list, bounds,
                  max_extend_length=5.0,
                  path_resolution=0.5,
                  goal_sample_rate=0.0,
                  max_iter=200,
-                 connect_circle_dist=50.0
+                 connect_circle_dist=50.0,
+                 seed=None,
+                 sample_block_size=1024,
+                 informed=False
                  ):
         super().__init__(start, goal, obstacle_list, bounds, max_extend_length,
-                         path_resolution, goal_sample_rate, max_iter)
+                         path_resolution, goal_sample_rate, max_iter, seed, sample_block_size)
         self.connect_circle_dist = connect_circle_dist
         self.goal = self.Node(goal)
+        self.informed = informed
+        self.best_cost = np.inf
 
-    def plan(self):
-        """Plans the path from start to goal while avoiding obstacles"""
-        self.node_list = [self.start]
+    def plan(self, callback=None):
+        """Plans the path from start to goal while avoiding obstacles. callback(self, i) is
+        called after every iteration i, and planning stops early if it returns True.
+        """
+        self.reset_tree(self.start)
         for i in range(self.max_iter):
             # Create a random node inside the bounded environment
             rnd = self.get_random_node()
             # Find nearest node
-            nearest_node = self.get_nearest_node(self.node_list, rnd)
+            nearest_node = self.nearest_node(rnd)
             # Get new node by connecting rnd_node and nearest_node
             new_node = self.steer(nearest_node, rnd, self.max_extend_length)
             # If path between new_node and nearest node is not in collision:
-            if not self.collision(new_node, nearest_node, self.obstacle_list):
+            if not self.collision(new_node, nearest_node, self.obstacle_grid):
                 near_inds = self.near_nodes_inds(new_node)
                 # Connect the new node to the best parent in near_inds
                 new_node = self.choose_parent(new_node, near_inds)
-                self.node_list.append(new_node)
+                self.add_node(new_node)
                 # Rewire the nodes in the proximity of new_node if it improves their costs
                 self.rewire(new_node, near_inds)
+                self.update_best_cost()
+            if callback is not None and callback(self, i):
+                break
         last_index, min_cost = self.best_goal_node_index()
         if last_index:
             return self.final_path(last_index), min_cost
         return None, min_cost
 
+    def reset_tree(self, root):
+        """Start a new tree from the root node"""
+        super().reset_tree(root)
+        # Nodes that can be connected to the goal, and the lengths of their connections
+        self.goal_inds, self.goal_dists = [], []
+        self.best_cost = np.inf
+        self.check_goal_node(0)
+
+    def add_node(self, node):
+        """Add node to the tree"""
+        super().add_node(node)
+        self.check_goal_node(node.index)
+
+    def check_goal_node(self, i):
+        """Remember node i if it can be connected to the goal"""
+        p = self.tree.positions[i]
+        if self.dist_to_goal(p) <= self.max_extend_length and not self.segment_collision(p, self.goal.p, self.obstacle_grid):
+            self.goal_inds.append(i)
+            self.goal_dists.append(self.dist_to_goal(p))
+
+    def update_best_cost(self):
+        """Update the cost of the best path from the nodes that can be connected to the goal,
+        which is the same as best_goal_node_index()[1] without a scan of the whole tree
+        """
+        if self.goal_inds:
+            self.best_cost = np.min(self.tree.costs[self.goal_inds] + self.goal_dists)
+
+    def get_random_node(self):
+        """Sample random node inside bounds or sample goal point. Once a path has been
+        found, informed sampling only samples points that could shorten it."""
+        if not self.informed or self.best_cost == np.inf:
+            return super().get_random_node()
+        while True:
+            if self.sample_ind == len(self.samples):
+                self.draw_samples()
+            i = self.sample_ind
+            self.sample_ind += 1
+            if self.sample_goal[i]:
+                return self.Node(self.goal.p)
+            p = self.informed_sample(self.samples[i])
+            if np.all((p >= self.bounds[0]) & (p <= self.bounds[1])):
+                return self.Node(p)
+
+    def informed_sample(self, sample):
+        """Map a uniform sample inside bounds to the ellipse of all points p with
+        |p - start| + |p - goal| <= best_cost
+        """
+        u = (sample - self.bounds[0]) / (self.bounds[1] - self.bounds[0])
+        # Uniform sample in the unit disk
+        disk = np.sqrt(u[0]) * np.array([np.cos(2*np.pi*u[1]), np.sin(2*np.pi*u[1])])
+        d = self.goal.p - self.start.p
+        min_cost = np.linalg.norm(d)
+        # Rotation of the x-axis onto the direction from start to goal
+        a = d / min_cost
+        rotation = np.array([[a[0], -a[1]], [a[1], a[0]]])
+        radii = np.array([self.best_cost, np.sqrt(max(self.best_cost**2 - min_cost**2, 0.0))]) / 2
+        return (self.start.p + self.goal.p) / 2 + rotation @ (radii * disk)
+
     def choose_parent(self, new_node, near_inds):
         """Set new_node.parent to the lowest resulting cost parent in near_inds and
         new_node.cost to the corresponding minimal cost
         """
         min_cost = np.inf
-        best_near_node = None
+        best_near_ind = None
+        positions, costs = self.tree.positions, self.tree.costs
         # modify here: Go through all near nodes and evaluate them as potential parent nodes by
         # 1) checking whether a connection would result in a collision,
         # 2) evaluating the cost of the new_node if it had that near node as a parent,
         # 3) picking the parent resulting in the lowest cost and updating
         #    the cost of the new_node to the minimum cost.
-        for ind in near_inds:
-          parent_node = self.node_list[ind]
-          if not self.collision(parent_node, new_node, self.obstacle_list):
-            cost = self.new_cost(parent_node, new_node)
+        collide = self.segments_collision(new_node.p, positions[near_inds], self.obstacle_grid)
+        for ind, is_collide in zip(near_inds, collide):
+          if not is_collide:
+            cost = costs[ind] + np.linalg.norm(positions[ind] - new_node.p)
             if cost < min_cost:
               min_cost = cost
-              best_near_node = parent_node
+              best_near_ind = ind
         
         # Don't need to modify beyond here
         new_node.cost = min_cost
-        new_node.parent = best_near_node
+        new_node.parent = None if best_near_ind is None else self.Node.handle(self.tree, best_near_ind)
         return new_node
     
     def rewire(self, new_node, near_inds):
@@ -338,12 +816,13 @@ class RRTStar(RRT):
         # A) Not cause a collision and
         # B) reduce their own cost.
         # If A and B are true, update the cost and parent properties of the node.
-        for ind in near_inds:
-          node = self.node_list[ind]
-          if not self.collision(new_node, node, self.obstacle_list):
-            new_cost = self.new_cost(new_node, node)
-            if new_cost < node.cost:
-              node.parent = new_node
+        positions, costs = self.tree.positions, self.tree.costs
+        collide = self.segments_collision(positions[near_inds], new_node.p, self.obstacle_grid)
+        for ind, is_collide in zip(near_inds, collide):
+          if not is_collide:
+            new_cost = new_node.cost + np.linalg.norm(new_node.p - positions[ind])
+            if new_cost < costs[ind]:
+              self.tree.set_parent(ind, new_node)
         # Don't need to modify beyond here
         self.propagate_cost_to_leaves(new_node)
 
@@ -351,27 +830,30 @@ class RRTStar(RRT):
         """Find the lowest cost node to the goal"""
         min_cost = np.inf
         best_goal_node_idx = None
-        for i in range(len(self.node_list)):
-            node = self.node_list[i]
+        n = len(self.tree)
+        positions, costs = self.tree.positions, self.tree.costs
+        # Only nodes roughly within max_extend_length are checked exactly
+        d = np.linalg.norm(positions[:n] - self.goal.p, axis=1)
+        inds = np.flatnonzero(d <= self.max_extend_length + 1e-9)
+        collide = self.segments_collision(positions[inds], self.goal.p, self.obstacle_grid)
+        for i, is_collide in zip(inds, collide):
             # Has to be in close proximity to the goal
-            if self.dist_to_goal(node.p) <= self.max_extend_length:
+            if self.dist_to_goal(positions[i]) <= self.max_extend_length:
                 # Connection between node and goal needs to be collision free
-                if not self.collision(self.goal, node, self.obstacle_list):
+                if not is_collide:
                     # The final path length
-                    cost = node.cost + self.dist_to_goal(node.p) 
-                    if node.cost + self.dist_to_goal(node.p) < min_cost:
+                    cost = costs[i] + self.dist_to_goal(positions[i])
+                    if cost < min_cost:
                         # Found better goal node!
                         min_cost = cost
-                        best_goal_node_idx = i
+                        best_goal_node_idx = int(i)
         return best_goal_node_idx, min_cost
 
     def near_nodes_inds(self, new_node):
         """Find the nodes in close proximity to new_node"""
         nnode = len(self.node_list) + 1
         r = self.connect_circle_dist * np.sqrt((np.log(nnode) / nnode))
-        dlist = [np.sum(np.square((node.p - new_node.p))) for node in self.node_list]
-        near_inds = [dlist.index(i) for i in dlist if i <= r ** 2]
-        return near_inds
+        return self.tree.grid.within(new_node.p, r)
 
     def new_cost(self, from_node, to_node):
         """to_node's new cost if from_node were the parent"""
@@ -380,10 +862,23 @@ class RRTStar(RRT):
 
     def propagate_cost_to_leaves(self, parent_node):
         """Recursively update the cost of the nodes"""
-        for node in self.node_list:
-            if node.parent == parent_node:
-                node.cost = self.new_cost(parent_node, node)
-                self.propagate_cost_to_leaves(node)
+        if parent_node.tree is self.tree:
+            self.propagate_cost_from(parent_node.index)
+            return
+        for ind, parent in self.tree.outside_parents.items():
+            if parent is parent_node:
+                self.tree.costs[ind] = self.new_cost(parent_node, self.Node.handle(self.tree, ind))
+                self.propagate_cost_from(ind)
+
+    def propagate_cost_from(self, ind):
+        """Update the cost of the descendants of node ind breadth-first"""
+        tree = self.tree
+        queue = collections.deque([ind])
+        while queue:
+            ind = queue.popleft()
+            for child in tree.children[ind]:
+                tree.costs[child] = tree.costs[ind] + np.linalg.norm(tree.positions[ind] - tree.positions[child])
+            queue.extend(tree.children[ind])
 
 np.random.seed(7)
 rrt_star = RRTStar(start=start,
@@ -411,6 +906,599 @@ else:
     plt.plot([x for (x, y) in path_rrt_star], [y for (x, y) in path_rrt_star], '-r')
 plt.tight_layout()
 
+"""# RRT-Connect
+The RRT only tries to connect its tree to the goal once a new node lands close to it. [RRT-Connect](https://www.cs.cmu.edu/afs/cs/academic/class/15494-s12/readings/kuffner_icra2000.pdf) grows one tree from the `start` and one from the `goal`. In every iteration, one tree is extended towards a random sample like in the RRT, and the other tree greedily grows towards the new node in steps of `max_extend_length` until it reaches the node or is blocked by an obstacle. Then the trees swap their roles. The path is found as soon as the two trees meet.
+"""
+
+class RRTConnect(RRT):
+
+    def plan(self):
+        """Plans the path from start to goal with trees grown from both"""
+        self.reset_tree(self.start)
+        self.goal_tree = Tree(self.bounds, dim=len(self.goal.p))
+        self.goal_tree.add(self.goal.p)
+        trees = [self.tree, self.goal_tree]
+        for i in range(self.max_iter):
+            rnd_node = self.get_random_node()
+            new_ind = self.extend(trees[0], rnd_node)
+            if new_ind is not None:
+                connect_ind, reached = self.connect(trees[1], trees[0].positions[new_ind])
+                if reached:
+                    if trees[0] is self.tree:
+                        return self.connected_path(new_ind, connect_ind)
+                    return self.connected_path(connect_ind, new_ind)
+            trees.reverse()
+        return None  # cannot find path
+
+    def extend(self, tree, node):
+        """Extend tree towards node and return the index of the new node, if any"""
+        nearest_node = self.Node.handle(tree, tree.grid.nearest(node.p))
+        new_node = self.steer(nearest_node, node, self.max_extend_length)
+        if self.collision(nearest_node, new_node, self.obstacle_grid):
+            return None
+        return tree.index_of(new_node)
+
+    def connect(self, tree, p):
+        """Extend tree towards p until p is reached or an obstacle is in the way.
+        Returns the index of the last node and whether p was reached."""
+        target = self.Node(p)
+        ind = tree.grid.nearest(p)
+        while not np.array_equal(tree.positions[ind], p):
+            from_node = self.Node.handle(tree, ind)
+            new_node = self.steer(from_node, target, self.max_extend_length)
+            if self.collision(from_node, new_node, self.obstacle_grid):
+                return ind, False
+            ind = tree.index_of(new_node)
+        return ind, True
+
+    def connected_path(self, start_ind, goal_ind):
+        """Path from the goal to the start through node start_ind of the start tree
+        and node goal_ind of the goal tree, which are at the same position"""
+        path = list(self.goal_tree.positions[self.goal_tree.path_to_root(goal_ind)][::-1])
+        return path + list(self.tree.positions[self.tree.path_to_root(start_ind)[1:]])
+
+    def draw_graph(self):
+        self.draw_tree(self.tree, "-g")
+        self.draw_tree(self.goal_tree, "-b")
+
+np.random.seed(7)
+rrt_connect = RRTConnect(start=start,
+                         goal=goal,
+                         bounds=bounds,
+                         obstacle_list=obstacles)
+path_rrt_connect = rrt_connect.plan()
+
+plt.figure(figsize=(6,6))
+plot_scene(obstacles, start, goal)
+rrt_connect.draw_graph()
+if path_rrt_connect is None:
+    print("No viable path found")
+else:
+    plt.plot([x for (x, y) in path_rrt_connect], [y for (x, y) in path_rrt_connect], '-r')
+    print('Length of the found path: {}'.format(path_cost(path_rrt_connect)))
+plt.tight_layout()
+
+"""# Performance
+The following sections measure how the planners scale to large trees and scenes.
+
+## Nearest Neighbor Queries
+We compare the brute-force `RRT.get_nearest_node` with a query of the `NodeGrid` for trees with $10^3$ and $10^4$ uniformly distributed nodes, and measure the wall time of `RRT.plan` in the empty scene with as many iterations as nodes. With `full_benchmarks = True`, trees with $10^5$ nodes are compared as well.
+"""
+
+def benchmark_nearest(n_list=(1000, 10000), n_queries=20, seed=0):
+    rng = np.random.RandomState(seed)
+    for n in n_list:
+        points = rng.rand(n, 2)*(bounds[1] - bounds[0]) + bounds[0]
+        queries = rng.rand(n_queries, 2)*(bounds[1] - bounds[0]) + bounds[0]
+        node_list = [RRT.Node(p) for p in points]
+        start_time = time.perf_counter()
+        tree = Tree(bounds)
+        for p in points:
+            tree.add(p)
+        grid = tree.grid
+        t_build = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        nearest_brute = [RRT.get_nearest_node(node_list, RRT.Node(q)) for q in queries]
+        t_brute = (time.perf_counter() - start_time) / n_queries
+        start_time = time.perf_counter()
+        nearest_grid = [grid.nearest(q) for q in queries]
+        t_grid = (time.perf_counter() - start_time) / n_queries
+        assert all(node is node_list[i] for node, i in zip(nearest_brute, nearest_grid))
+        print("n = {:6d}: brute force {:8.1f} us/query, grid {:5.1f} us/query, grid construction {:.1f} us/node".format(
+            n, 1e6*t_brute, 1e6*t_grid, 1e6*t_build/n))
+    for n in n_list:
+        np.random.seed(seed)
+        rrt = RRT(start=start, goal=goal_out_of_bound, bounds=bounds, obstacle_list=[],
+                  goal_sample_rate=0.0, max_iter=n)
+        start_time = time.perf_counter()
+        rrt.plan()
+        print("RRT.plan with max_iter = {:6d}: {:.2f}s".format(n, time.perf_counter() - start_time))
+
+benchmark_nearest((1000, 10000, 100000) if full_benchmarks else (1000, 10000))
+
+"""## Tree Storage
+We compare the memory of a tree stored as a list of `Node` objects, each with its own position array, with the arrays of a `Tree`, and how many iterations per second the planners run in the scene above. `LegacyRRT` and `LegacyRRTStar` are copies of the planners before the trees were stored in arrays: they keep a list of `Node` objects, search it for the nearest node, check one obstacle at a time and propagate costs recursively through the whole list. By default the trees have $10^4$ nodes and the planners run for 200 iterations; with `full_benchmarks = True`, $10^5$ nodes and 2000 iterations as well.
+"""
+
+class LegacyRRT(RRT):
+
+    class Node:
+        def __init__(self, p):
+            self.p = np.array(p)
+            self.parent = None
+
+    def plan(self):
+        """Plans the path from start to goal while avoiding obstacles"""
+        self.nodes = [self.start]
+        for i in range(self.max_iter):
+            rnd_node = self.get_random_node()
+            nearest_node = RRT.get_nearest_node(self.nodes, rnd_node)
+            new_node = self.steer(nearest_node, rnd_node)
+            if not RRT.collision(nearest_node, new_node, self.obstacle_list):
+                self.nodes.append(new_node)
+            if self.dist_to_goal(self.nodes[-1].p) <= self.max_extend_length:
+                final_node = self.steer(self.nodes[-1], self.goal, self.max_extend_length)
+                if not self.collision(final_node, self.nodes[-1], self.obstacle_list):
+                    return self.final_path(self.nodes[-1])
+        return None  # cannot find path
+
+    def get_random_node(self):
+        """Sample random node inside bounds or sample goal point"""
+        if np.random.rand() > self.goal_sample_rate:
+            return self.Node(np.random.rand(2)*(self.bounds[1]-self.bounds[0]) + self.bounds[0])
+        return self.Node(self.goal.p)
+
+    @staticmethod
+    def collision(node1, node2, obstacle_list):
+        """Check whether the path connecting node1 and node2
+        is in collision with anyting from the obstacle_list
+        """
+        return RRT.segment_collision_loop(node2.p, node1.p, obstacle_list)
+
+    def final_path(self, node):
+        """Compute the final path from node to the start node"""
+        path = [self.goal.p]
+        while node is not None:
+            path.append(node.p)
+            node = node.parent
+        return path
+
+class LegacyRRTStar(LegacyRRT):
+
+    class Node(LegacyRRT.Node):
+        def __init__(self, p):
+            super().__init__(p)
+            self.cost = 0.0
+
+    def __init__(self, start, goal, obstacle_list, bounds, max_extend_length=5.0,
+                 goal_sample_rate=0.0, max_iter=200, connect_circle_dist=50.0):
+        super().__init__(start, goal, obstacle_list, bounds, max_extend_length,
+                         goal_sample_rate=goal_sample_rate, max_iter=max_iter)
+        self.connect_circle_dist = connect_circle_dist
+
+    def plan(self):
+        """Plans the path from start to goal while avoiding obstacles"""
+        self.nodes = [self.start]
+        for i in range(self.max_iter):
+            rnd = self.get_random_node()
+            nearest_node = self.get_nearest_node(self.nodes, rnd)
+            new_node = self.steer(nearest_node, rnd, self.max_extend_length)
+            if not self.collision(new_node, nearest_node, self.obstacle_list):
+                near_inds = self.near_nodes_inds(new_node)
+                new_node = self.choose_parent(new_node, near_inds)
+                self.nodes.append(new_node)
+                self.rewire(new_node, near_inds)
+        best_node, min_cost = None, np.inf
+        for node in self.nodes:
+            if (self.dist_to_goal(node.p) <= self.max_extend_length
+                    and not self.collision(self.goal, node, self.obstacle_list)
+                    and node.cost + self.dist_to_goal(node.p) < min_cost):
+                best_node, min_cost = node, node.cost + self.dist_to_goal(node.p)
+        if best_node is not None:
+            return self.final_path(best_node), min_cost
+        return None, min_cost
+
+    def choose_parent(self, new_node, near_inds):
+        """Connect new_node to the near node that results in the lowest cost"""
+        new_node.cost, new_node.parent = np.inf, None
+        for ind in near_inds:
+            parent_node = self.nodes[ind]
+            if not self.collision(parent_node, new_node, self.obstacle_list):
+                cost = self.new_cost(parent_node, new_node)
+                if cost < new_node.cost:
+                    new_node.cost, new_node.parent = cost, parent_node
+        return new_node
+
+    def rewire(self, new_node, near_inds):
+        """Rewire near nodes to new_node if this will result in a lower cost"""
+        for ind in near_inds:
+            node = self.nodes[ind]
+            if not self.collision(new_node, node, self.obstacle_list):
+                if self.new_cost(new_node, node) < node.cost:
+                    node.parent = new_node
+        self.propagate_cost_to_leaves(new_node)
+
+    def near_nodes_inds(self, new_node):
+        """Find the nodes in close proximity to new_node"""
+        nnode = len(self.nodes) + 1
+        r = self.connect_circle_dist * np.sqrt((np.log(nnode) / nnode))
+        dlist = [np.sum(np.square((node.p - new_node.p))) for node in self.nodes]
+        return [dlist.index(i) for i in dlist if i <= r ** 2]
+
+    def new_cost(self, from_node, to_node):
+        """to_node's new cost if from_node were the parent"""
+        return from_node.cost + np.linalg.norm(from_node.p - to_node.p)
+
+    def propagate_cost_to_leaves(self, parent_node):
+        """Recursively update the cost of the nodes"""
+        for node in self.nodes:
+            if node.parent == parent_node:
+                node.cost = self.new_cost(parent_node, node)
+                self.propagate_cost_to_leaves(node)
+
+def benchmark_tree(n=10000, max_iter_list=(200,), seed=0):
+    rng = np.random.RandomState(seed)
+    points = rng.rand(n, 2)*(bounds[1] - bounds[0]) + bounds[0]
+    tracemalloc.start()
+    node_list = []
+    for p in points:
+        node = LegacyRRTStar.Node(p)
+        node.parent = node_list[-1] if node_list else None
+        node_list.append(node)
+    memory_nodes = tracemalloc.get_traced_memory()[0]
+    del node_list
+    tracemalloc.stop()
+    tracemalloc.start()
+    tree = Tree(bounds)
+    for i, p in enumerate(points):
+        tree.add(p, i - 1)
+    memory_tree = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print("n = {}: Node objects {:.0f} bytes/node, Tree {:.0f} bytes/node".format(
+        n, memory_nodes/n, memory_tree/n))
+    for legacy_planner, planner in ((LegacyRRT, RRT), (LegacyRRTStar, RRTStar)):
+        for max_iter in max_iter_list:
+            rates = []
+            for planner_class in (legacy_planner, planner):
+                np.random.seed(seed)
+                planner_obj = planner_class(start=start, goal=goal_out_of_bound, bounds=bounds,
+                                            obstacle_list=obstacles, goal_sample_rate=0.0, max_iter=max_iter)
+                start_time = time.perf_counter()
+                planner_obj.plan()
+                rates.append(max_iter/(time.perf_counter() - start_time))
+            print("{}.plan with max_iter = {:5d}: Node list {:5.0f} iterations/s, Tree {:5.0f} iterations/s".format(
+                planner.__name__, max_iter, *rates))
+
+benchmark_tree(100000 if full_benchmarks else 10000, (200, 2000) if full_benchmarks else (200,))
+
+"""## Collision Checking
+`RRT.segments_collision` checks segments against all circles of the packed obstacle array at once, in blocks of obstacles so that it can stop as soon as every segment is known to be in collision. We compare it with checking one obstacle at a time for scenes of up to $10^3$ random circles of the same total width, and measure RRT* in those scenes. With `full_benchmarks = True`, a scene of $10^4$ circles is measured as well.
+"""
+
+def random_obstacles(n, radius=0.05, seed=0):
+    rng = np.random.RandomState(seed)
+    centers = rng.rand(n, 2)*(bounds[1] - bounds[0]) + bounds[0]
+    return np.hstack((centers, np.full((n, 1), radius)))
+
+def benchmark_collision(n_list=(6, 100, 1000), width=40.0, n_segments=200, max_iter=200, seed=0):
+    rng = np.random.RandomState(seed)
+    for n in n_list:
+        # The total width of the obstacles is the same in all scenes, so that RRT* grows a tree in each
+        obstacles_n = random_obstacles(n, radius=width/(2*n), seed=seed)
+        p1 = rng.rand(n_segments, 2)*(bounds[1] - bounds[0]) + bounds[0]
+        p2 = p1 + rng.randn(n_segments, 2)
+        start_time = time.perf_counter()
+        collide_loop = [RRT.segment_collision_loop(a, b, obstacles_n) for a, b in zip(p1, p2)]
+        t_loop = (time.perf_counter() - start_time) / n_segments
+        start_time = time.perf_counter()
+        collide = [RRT.segment_collision(a, b, obstacles_n) for a, b in zip(p1, p2)]
+        t_vectorized = (time.perf_counter() - start_time) / n_segments
+        start_time = time.perf_counter()
+        collide_batch = RRT.segments_collision(p1, p2, obstacles_n)
+        t_batch = (time.perf_counter() - start_time) / n_segments
+        assert collide == collide_loop and list(collide_batch) == collide_loop
+        np.random.seed(seed)
+        rrt_star = RRTStar(start=start, goal=goal, bounds=bounds, obstacle_list=obstacles_n,
+                           max_iter=max_iter)
+        start_time = time.perf_counter()
+        rrt_star.plan()
+        t_plan = time.perf_counter() - start_time
+        print("{:5d} obstacles: loop {:8.1f} us/segment, vectorized {:6.1f} us/segment, batch {:6.1f} us/segment, RRT* {:.2f}s, {} nodes".format(
+            n, 1e6*t_loop, 1e6*t_vectorized, 1e6*t_batch, t_plan, len(rrt_star.tree)))
+    # The scene above is checked one obstacle at a time as well
+    p1 = rng.rand(n_segments, 2)*(bounds[1] - bounds[0]) + bounds[0]
+    p2 = p1 + rng.randn(n_segments, 2)
+    assert all(RRT.segment_collision(a, b, obstacles) == RRT.segment_collision_loop(a, b, obstacles)
+               for a, b in zip(p1, p2))
+
+benchmark_collision((6, 100, 1000, 10000) if full_benchmarks else (6, 100, 1000))
+
+"""## Radius Queries
+`RRTStar.near_nodes_inds` queries the `NodeGrid` for the nodes within the connection radius. Looking up the index of every distance in the list of all distances made each query $O(n^2)$ and returned the first of several nodes at exactly the same distance twice. We check that the radius query grows the same trees in the scene above as the list lookup, and compare the time of a query for trees with $10^3$ and $10^4$ nodes, and with $10^5$ nodes as well with `full_benchmarks = True`.
+"""
+
+class RRTStarListLookup(RRTStar):
+
+    def near_nodes_inds(self, new_node):
+        """Find the nodes in close proximity to new_node by looking up their distances"""
+        nnode = len(self.node_list) + 1
+        r = self.connect_circle_dist * np.sqrt((np.log(nnode) / nnode))
+        dlist = list(np.sum(np.square(self.tree.positions[:len(self.tree)] - new_node.p), axis=1))
+        near_inds = [dlist.index(i) for i in dlist if i <= r ** 2]
+        return near_inds
+
+def check_radius_parity(runs=((7, 200), (7, 300), (3, 500))):
+    # Both planners grow the same trees from the same seeds
+    for seed, max_iter in runs:
+        trees = []
+        for planner_class in (RRTStar, RRTStarListLookup):
+            np.random.seed(seed)
+            planner = planner_class(start=start, goal=goal, bounds=bounds, obstacle_list=obstacles,
+                                    max_iter=max_iter)
+            planner.plan()
+            n = len(planner.tree)
+            trees.append((planner.tree.positions[:n], planner.tree.parents[:n], planner.tree.costs[:n]))
+        assert all(np.array_equal(a, b) for a, b in zip(*trees))
+
+check_radius_parity()
+
+
+def benchmark_radius(n_list=(1000, 10000), n_queries=20, connect_circle_dist=50.0, seed=0):
+    rng = np.random.RandomState(seed)
+    for n in n_list:
+        rrt_star = RRTStar(start=start, goal=goal, bounds=bounds, obstacle_list=[],
+                           connect_circle_dist=connect_circle_dist)
+        rrt_star_list = RRTStarListLookup(start=start, goal=goal, bounds=bounds, obstacle_list=[],
+                                          connect_circle_dist=connect_circle_dist)
+        points = rng.rand(n, 2)*(bounds[1] - bounds[0]) + bounds[0]
+        rrt_star.tree = rrt_star_list.tree = Tree(bounds)
+        for p in points:
+            rrt_star.tree.add(p)
+        queries = [RRTStar.Node(q) for q in rng.rand(n_queries, 2)*(bounds[1] - bounds[0]) + bounds[0]]
+        start_time = time.perf_counter()
+        near_list = [rrt_star_list.near_nodes_inds(q) for q in queries]
+        t_list = (time.perf_counter() - start_time) / n_queries
+        start_time = time.perf_counter()
+        near_grid = [rrt_star.near_nodes_inds(q) for q in queries]
+        t_grid = (time.perf_counter() - start_time) / n_queries
+        assert all(list(a) == b for a, b in zip(near_grid, near_list))
+        print("n = {:6d}: {:5.1f} nodes/query, list lookup {:8.1f} us/query, grid {:6.1f} us/query".format(
+            n, np.mean([len(a) for a in near_grid]), 1e6*t_list, 1e6*t_grid))
+
+benchmark_radius((1000, 10000, 100000) if full_benchmarks else (1000, 10000))
+
+"""## Cost Propagation
+Every tree keeps the list of children of each node, so that after rewiring RRT* only visits the subtree of the new node, breadth-first and without recursion. We run RRT* in the scene above with an increasing number of iterations and measure how much of the time is spent propagating costs. To check that deep trees are no problem, we also propagate a cost change along a chain of $10^4$ nodes, which is far deeper than Python's recursion limit. With `full_benchmarks = True`, RRT* also runs for 20000 iterations and the chain has $10^5$ nodes.
+"""
+
+def benchmark_rrt_star(max_iter_list=(200, 2000), chain_length=10000, seed=0):
+    for max_iter in max_iter_list:
+        np.random.seed(seed)
+        rrt_star = RRTStar(start=start, goal=goal, bounds=bounds, obstacle_list=obstacles,
+                           max_iter=max_iter)
+        propagate = rrt_star.propagate_cost_to_leaves
+        t_propagate = 0.0
+        def timed_propagate(parent_node):
+            nonlocal t_propagate
+            start_time = time.perf_counter()
+            propagate(parent_node)
+            t_propagate += time.perf_counter() - start_time
+        rrt_star.propagate_cost_to_leaves = timed_propagate
+        start_time = time.perf_counter()
+        path, min_cost = rrt_star.plan()
+        t_plan = time.perf_counter() - start_time
+        print("RRT* with max_iter = {:5d}: {:6.2f}s, {:5.0f} iterations/s, {:.2f}s propagating costs, minimum cost {:.3f}".format(
+            max_iter, t_plan, max_iter/t_plan, t_propagate, min_cost))
+    rrt_star = RRTStar(start=start, goal=goal, bounds=bounds, obstacle_list=[])
+    rrt_star.tree = Tree(bounds)
+    for i, x in enumerate(np.linspace(bounds[0], bounds[1], chain_length)):
+        rrt_star.tree.add([x, 0.0], i - 1)
+    start_time = time.perf_counter()
+    rrt_star.propagate_cost_to_leaves(rrt_star.node_list[0])
+    print("Propagating costs along a chain of {} nodes: {:.2f}s, cost of the leaf {:.3f}".format(
+        chain_length, time.perf_counter() - start_time, rrt_star.tree.costs[chain_length - 1]))
+
+benchmark_rrt_star((200, 2000, 20000) if full_benchmarks else (200, 2000), 100000 if full_benchmarks else 10000)
+
+"""## Obstacle Fields
+Every planner builds an `ObstacleGrid` of its obstacles. We check that it finds the same collisions as checking all obstacles, and compare the iterations per second of the planners in the scene above with fields of $10^2$ and $10^3$ small random circles of the same total width, with and without the broad phase. With `full_benchmarks = True`, the fields have $10^3$ and $10^4$ circles and the planners run for 2000 iterations.
+"""
+
+def benchmark_obstacle_grid(n_list=(100, 1000), width=40.0, max_iter=200, n_segments=2000, seed=0):
+    # The total width of the obstacles is the same in all fields
+    obstacle_fields = [random_obstacles(n, radius=width/(2*n), seed=seed) for n in n_list]
+    rng = np.random.RandomState(seed)
+    for obstacles_n in obstacle_fields:
+        p1 = rng.rand(n_segments, 2)*(bounds[1] - bounds[0]) + bounds[0]
+        p2 = p1 + rng.randn(n_segments, 2)
+        assert np.array_equal(ObstacleGrid(obstacles_n).segments_collision(p1, p2),
+                              RRT.segments_collision(p1, p2, obstacles_n))
+    for planner in (RRT, RRTStar):
+        for obstacles_n, broad_phase in [(obstacles, True)] + [
+                (obstacles_n, b) for obstacles_n in obstacle_fields for b in (False, True)]:
+            np.random.seed(seed)
+            planner_obj = planner(start=start, goal=goal_out_of_bound, bounds=bounds, obstacle_list=obstacles_n,
+                                  goal_sample_rate=0.0, max_iter=max_iter)
+            if not broad_phase:
+                planner_obj.obstacle_grid = pack_obstacles(obstacles_n)
+            start_time = time.perf_counter()
+            planner_obj.plan()
+            duration = time.perf_counter() - start_time
+            print("{:7s} {:5d} obstacles, {:11s}: {:6.0f} iterations/s, {:5d} nodes".format(
+                planner.__name__, len(obstacles_n), "grid" if broad_phase else "all checked",
+                max_iter/duration, len(planner_obj.tree)))
+
+benchmark_obstacle_grid((1000, 10000) if full_benchmarks else (100, 1000),
+                        max_iter=2000 if full_benchmarks else 200)
+
+"""## Random Samples
+Every planner draws its samples from its own `numpy.random.Generator`, in blocks of `sample_block_size` points and goal sampling decisions. Planners with the same `seed` grow the same tree, even if other code uses the global generator in between, and planners without a `seed` draw one from the global generator. We compare the time per sample with drawing every sample from the global generator.
+"""
+
+def benchmark_samples(n_samples=100000, seed=0):
+    rrt = RRT(start=start, goal=goal, bounds=bounds, obstacle_list=obstacles, seed=seed)
+    start_time = time.perf_counter()
+    for i in range(n_samples):
+        LegacyRRT.get_random_node(rrt)
+    t_legacy = (time.perf_counter() - start_time) / n_samples
+    start_time = time.perf_counter()
+    for i in range(n_samples):
+        rrt.get_random_node()
+    t_block = (time.perf_counter() - start_time) / n_samples
+    print("Global generator {:.2f} us/sample, blocks {:.2f} us/sample".format(1e6*t_legacy, 1e6*t_block))
+    trees = []
+    for interleave in (False, True):
+        rrt_star = RRTStar(start=start, goal=goal, bounds=bounds, obstacle_list=obstacles, seed=seed)
+        if interleave:
+            # Other code using the global generator does not change the samples
+            get_random_node = rrt_star.get_random_node
+            def interleaved_random_node():
+                np.random.rand()
+                return get_random_node()
+            rrt_star.get_random_node = interleaved_random_node
+        rrt_star.plan()
+        n = len(rrt_star.tree)
+        trees.append((rrt_star.tree.positions[:n], rrt_star.tree.parents[:n]))
+    assert all(np.array_equal(a, b) for a, b in zip(*trees))
+
+benchmark_samples()
+
+"""## Parallel Planning
+The paths found by the planners vary a lot between seeds. `plan_parallel` runs the planner with several seeds in a pool of processes. In `"first"` mode it returns the first path that is found and terminates the remaining planners; in `"best"` mode it returns the shortest path found within `time_budget` seconds. Both return the seed, the path and its length, and the number of seeds that found a path. RRT* planners stop at the end of the time budget and return the best path they have found so far. Planners that are still running after that (or, in `"first"` mode, when the first path is found) are terminated, and like the planners that finish without a path they are not counted. If no seed finds a path, the seed and the path are `None` and the length is infinite.
+"""
+
+def plan_seed(seed, planner, kwargs, deadline=None):
+    """Plan with the given seed and return the seed, the path and its length. RRTStar
+    stops at the deadline (a time.perf_counter value) with the best path found so far.
+    """
+    if deadline is not None and issubclass(planner, RRTStar):
+        path = planner(seed=seed, **kwargs).plan(callback=lambda planner, i: time.perf_counter() >= deadline)
+    else:
+        path = planner(seed=seed, **kwargs).plan()
+    if isinstance(path, tuple):
+        # RRTStar.plan returns the minimum cost as well
+        path = path[0]
+    return seed, path, np.inf if path is None else path_cost(path)
+
+def plan_parallel(planner, seeds, mode="first", time_budget=None, processes=None, grace=1.0, **kwargs):
+    """Plan with every seed in seeds in parallel and return the seed, the path and its length
+    of the first or of the best path, and the number of seeds that found a path. The seed
+    and the path are None if no seed found a path. RRTStar planners stop at the end of
+    time_budget, and their paths are collected for up to grace more seconds.
+    """
+    if mode not in ("first", "best"):
+        raise ValueError("mode has to be 'first' or 'best'")
+    deadline = None if time_budget is None else time.perf_counter() + time_budget
+    best = (None, None, np.inf)
+    n_succeeded = 0
+    # Workers are forked, so they inherit all planners defined in the notebook
+    pool = multiprocessing.get_context("fork").Pool(processes)
+    try:
+        results = pool.imap_unordered(functools.partial(plan_seed, planner=planner, kwargs=kwargs,
+                                                        deadline=deadline), seeds)
+        for _ in seeds:
+            timeout = None if deadline is None else max(deadline + grace - time.perf_counter(), 0.0)
+            try:
+                result = results.next(timeout)
+            except multiprocessing.TimeoutError:
+                break
+            if result[1] is None:
+                continue
+            n_succeeded += 1
+            if result[2] < best[2]:
+                best = result
+            if mode == "first":
+                break
+    finally:
+        # Stop the planners that are still running
+        pool.terminate()
+    return best + (n_succeeded,)
+
+def benchmark_parallel(n_seeds=8, time_budget=5.0):
+    seeds = list(range(n_seeds))
+    for planner, mode, kwargs in [(RRT, "first", {}), (RRTStar, "best", dict(max_iter=1000))]:
+        start_time = time.perf_counter()
+        serial = [plan_seed(seed, planner, dict(start=start, goal=goal, bounds=bounds,
+                                                obstacle_list=obstacles, **kwargs)) for seed in seeds]
+        t_serial = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        seed, path, length, n_succeeded = plan_parallel(planner, seeds, mode, time_budget, start=start, goal=goal,
+                                                        bounds=bounds, obstacle_list=obstacles, **kwargs)
+        t_parallel = time.perf_counter() - start_time
+        print("{} {:5s}: serial {:.2f}s, shortest path {:.3f}; parallel {:.2f}s, seed {}, path length {:.3f}, "
+              "{} of {} seeds found a path".format(planner.__name__, mode, t_serial, min(result[2] for result in serial),
+                                                   t_parallel, seed, length, n_succeeded, n_seeds))
+
+    print("{} CPUs".format(os.cpu_count()))
+
+benchmark_parallel()
+
+"""## RRT-Connect
+We compare the number of iterations, the number of nodes and the time until the first solution of the RRT and of RRT-Connect over 10 seeds (100 seeds with `full_benchmarks = True`), in the scene above and in a scene with a narrow passage through a wall of obstacles.
+"""
+
+def count_iterations(planner):
+    # Every iteration of the planners draws exactly one random node
+    planner.iterations = 0
+    get_random_node = planner.get_random_node
+    def counted_random_node():
+        planner.iterations += 1
+        return get_random_node()
+    planner.get_random_node = counted_random_node
+
+def benchmark_connect(n_seeds=10, max_iter=5000):
+    # A wall at y = 4 between start and goal with a narrow gap at x = 0
+    wall = [np.array([x, 4.0, 0.55]) for x in np.arange(-2.0, 15.5, 1.0) if x != 0.0]
+    for scene, obstacles_scene in [("scene above", obstacles), ("narrow passage", wall)]:
+        for planner in (RRT, RRTConnect):
+            iterations, nodes, durations, lengths = [], [], [], []
+            for seed in range(n_seeds):
+                planner_obj = planner(start=start, goal=goal, bounds=bounds, obstacle_list=obstacles_scene,
+                                      max_iter=max_iter, seed=seed)
+                count_iterations(planner_obj)
+                start_time = time.perf_counter()
+                path = planner_obj.plan()
+                if path is not None:
+                    durations.append(time.perf_counter() - start_time)
+                    iterations.append(planner_obj.iterations)
+                    nodes.append(len(planner_obj.tree) + len(getattr(planner_obj, "goal_tree", [])))
+                    lengths.append(path_cost(path))
+            print("{:14s} {:10s}: {:3d}/{} solved, median {:5.0f} iterations, {:5.0f} nodes, {:6.2f} ms, path length {:.2f}".format(
+                scene, planner.__name__, len(durations), n_seeds, np.median(iterations), np.median(nodes),
+                1e3*np.median(durations), np.median(lengths)))
+
+benchmark_connect(100 if full_benchmarks else 10)
+
+"""## Informed Sampling
+With `informed=True`, RRT* samples uniformly from the ellipse of all points whose distances to the `start` and the `goal` add up to at most the cost of the best path found so far, as soon as there is one. Only these points can be on a shorter path. We plot the cost of the best path after every iteration for both modes, with the median over 3 seeds and 500 iterations, or 10 seeds and 1000 iterations with `full_benchmarks = True`.
+"""
+
+def benchmark_informed(n_seeds=3, max_iter=500, checkpoints=(100, 200, 500, 1000)):
+    plt.figure(figsize=(6, 4))
+    for informed in (False, True):
+        costs = np.full((n_seeds, max_iter), np.inf)
+        start_time = time.perf_counter()
+        for seed in range(n_seeds):
+            rrt_star = RRTStar(start=start, goal=goal, bounds=bounds, obstacle_list=obstacles,
+                               max_iter=max_iter, seed=seed, informed=informed)
+            def record_cost(planner, i):
+                costs[seed, i] = planner.best_cost
+            rrt_star.plan(callback=record_cost)
+            assert rrt_star.best_cost == rrt_star.best_goal_node_index()[1]
+        duration = time.perf_counter() - start_time
+        label = "informed" if informed else "uniform"
+        median = np.median(costs, axis=0)
+        plt.plot(np.arange(1, max_iter + 1), median, label=label)
+        print("{:8s}: median cost {}, {:.2f}s per plan".format(label, ", ".join(
+            "{:.3f} after {}".format(median[i - 1], i) for i in checkpoints if i <= max_iter), duration/n_seeds))
+    plt.xlabel("iteration")
+    plt.ylabel("median cost of the best path")
+    plt.ylim(np.linalg.norm(goal - start), None)
+    plt.legend()
+    plt.tight_layout()
+
+benchmark_informed(10 if full_benchmarks else 3, 1000 if full_benchmarks else 500)
+
 """## Autograding
 You can check your work by running the following cell.
 """